@@ -1,15 +1,80 @@
+import os
 import socket
+import re
 import csv
-import numpy as np
 import adal
 import flask
 import uuid
+import secrets
 import requests
-from random import randint
+from typing import NamedTuple, Optional
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+# Cell range address in A1-style notation, e.g. A1 or A1:C10
+_RANGE_RE = re.compile(r'[A-Z]+\d+(?::[A-Z]+\d+)?', re.IGNORECASE)
+
+def _shape(table):
+    '''
+    Counts the rows and columns of a table given as a list of rows.
+
+    :param table:  The table
+    :type:         list
+    :return:       The number of rows and columns,
+                   or None if a row is not a list or the rows differ in length
+    :type:         tuple
+    '''
+    if not all(isinstance(line, list) for line in table):
+        return None
+    cols = len(table[0]) if table else 0
+    if any(len(line) != cols for line in table):
+        return None
+    return (len(table), cols)
+
+
+def _encode_col(col):
+    '''
+    Converts a column number to excel column letters, e.g. 1 -> A, 27 -> AA.
+
+    :param col:  The column number, starting with 1
+    :type:       int
+    :return:     The column letters
+    :type:       str
+    '''
+    n = col
+    letters = []
+    while n > 0:
+        n, r = divmod(n - 1, 26)
+        letters.append(chr(65 + r))
+    return ''.join(reversed(letters))
+
 
 app = flask.Flask(__name__)
-app.debug = True
-app.secret_key = 'development'
+app.debug = os.environ.get("DEBUG") == "1"
+# Signs the session cookie holding the OAuth state and token.
+# Without SECRET_KEY every process gets its own random key, so set it when running several workers
+app.secret_key = os.environ.get("SECRET_KEY") or secrets.token_hex(32)
+
+# Headers shared by every Graph API call
+_BASE_HEADERS = {'User-Agent': 'adal-python-sample',
+                 'Accept': 'application/json',
+                 'Accept-Encoding': requests.utils.DEFAULT_ACCEPT_ENCODING,
+                 'Content-Type': 'application/json'}
+
+# One session for the whole app, so connections to the Graph API are kept alive and reused
+_SESSION = requests.Session()
+_SESSION.headers.update(_BASE_HEADERS)
+_METHOD_TABLE = {'get': _SESSION.get, 'put': _SESSION.put, 'patch': _SESSION.patch,
+                 'post': _SESSION.post, 'delete': _SESSION.delete}
+
+class GraphRequest(NamedTuple):
+  """The endpoint, the type and the body of a query to the Graph API"""
+  endpoint: str
+  method: str
+  body: Optional[dict]
+
 
 class ExcelClient(object):
   """Class object of ExcelClient"""
@@ -43,7 +108,27 @@ class ExcelClient(object):
                                'state={}&resource={}')
     self.HOST = HOST
     self.PORT = PORT
-    self.REDIRECT_URI = 'http://{0}:{1}/getAToken'.format(self.HOST, self.PORT)
+    self.REDIRECT_URI = f'http://{self.HOST}:{self.PORT}/getAToken'
+
+  def _range_url(self, file_id, sheetname, range, suffix=""):
+    '''
+    Checks the range address and forms the endpoint of the range object.
+    Override to address ranges differently.
+
+    :param file_id:   Id excel file
+    :type:            str
+    :param sheetname: The name of the sheet in the excel file
+    :type:            str
+    :param range:     The range of cells
+    :type:            str
+    :param suffix:    The path appended to the range endpoint, e.g. "/clear"
+    :type:            str
+    :return:          The endpoint of the range object
+    :type:            str
+    '''
+    if not _RANGE_RE.fullmatch(range):
+      raise ValueError(f"Invalid range {range!r}")
+    return f"/me/drive/items/{file_id}/workbook/worksheets/{sheetname}/range(address='{range}'){suffix}"
 
   def update_range(self, file_id, sheetname, range, data, format=None,
                    columnHidden=None, formulas=None, formulasLocal=None,
@@ -76,41 +161,40 @@ class ExcelClient(object):
     :type:                 list
     :param rowHidden:	     Represents if all rows of the current range are hidden.
     :type:                 bool
-    :return:               The list with the endpoint of the query, the type of the query and the body of the query
-    :type:                 list
+    :return:               The endpoint of the query, the type of the query and the body of the query
+    :type:                 GraphRequest
     '''
-    for [k, v] in {'file_id': file_id, 'sheetname': sheetname, 'range': range}.items():
-      if type(v) is not str:
-        raise TypeError("Invalid {0} type".format(k))
+    for k, v in (('file_id', file_id), ('sheetname', sheetname), ('range', range)):
+      if not isinstance(v, str):
+        raise TypeError(f"Invalid {k} type")
     if data is None:
       raise ValueError("Invalid data")
-    size = np.shape(data)
-    for [k, v] in {"data": data, "format": format, "formulas": formulas,
-                   "formulasLocal": formulasLocal, "formulasR1C1": formulasR1C1}.items():
+    if not isinstance(data, list):
+      raise TypeError("Invalid data type")
+    size = _shape(data)
+    if size is None:
+      raise ValueError("Invalid format of data. Number of columns in lines differ")
+    for k, v in (('format', format), ('formulas', formulas),
+                 ('formulasLocal', formulasLocal), ('formulasR1C1', formulasR1C1)):
       if v is not None:
-        if type(v) is not list:
-          raise TypeError("Invalid {0} type".format(k))
-        if np.shape(v) != size:
-          raise ValueError("{0} shape and data shape must be the same".format(k))
-    for [k, v] in {"columnHidden": columnHidden, "rowHidden": rowHidden}.items():
-      if v is not None and type(v) is not bool:
-        raise TypeError("Invalid {0} type".format(k))
-
-    request_body = {
-      "values": data,
-      "numberFormat": format,
-      "columnHidden": columnHidden,
-      "formulas": formulas,
-      "formulasLocal": formulasLocal,
-      "formulasR1C1": formulasR1C1,
-      "rowHidden": rowHidden
-    }
-    for [k, v] in request_body.items():
-      if v is None:
-        del request_body[k]
-
-    return ["/me/drive/items/{0}/workbook/worksheets/{1}/range(address=\'{2}\')".format(file_id, sheetname, range),
-            "patch", request_body]
+        if not isinstance(v, list):
+          raise TypeError(f"Invalid {k} type")
+        if _shape(v) != size:
+          raise ValueError(f"{k} shape and data shape must be the same")
+    if columnHidden is not None and not isinstance(columnHidden, bool):
+      raise TypeError("Invalid columnHidden type")
+    if rowHidden is not None and not isinstance(rowHidden, bool):
+      raise TypeError("Invalid rowHidden type")
+
+    request_body = {k: v for k, v in (("values", data),
+                                      ("numberFormat", format),
+                                      ("columnHidden", columnHidden),
+                                      ("formulas", formulas),
+                                      ("formulasLocal", formulasLocal),
+                                      ("formulasR1C1", formulasR1C1),
+                                      ("rowHidden", rowHidden)) if v is not None}
+
+    return GraphRequest(self._range_url(file_id, sheetname, range), "patch", request_body)
 
   def get_range(self, file_id, sheetname, range):
     '''
@@ -123,14 +207,13 @@ class ExcelClient(object):
       :type:            str
       :param range:     The range of cells for writing data
       :type:            str
-      :return:          The list with the endpoint of the query, the type of the query and the body of the query
-      :type:            list
+      :return:          The endpoint of the query, the type of the query and the body of the query
+      :type:            GraphRequest
     '''
-    for [k, v] in {'file_id': file_id, 'sheetname': sheetname, 'range': range}.items():
-      if type(v) is not str:
-        raise TypeError("Invalid {0} type".format(k))
-    return ["/me/drive/items/{0}/workbook/worksheets/{1}/range(address=\'{2}\')".format(file_id, sheetname, range),
-            "get", None]
+    for k, v in (('file_id', file_id), ('sheetname', sheetname), ('range', range)):
+      if not isinstance(v, str):
+        raise TypeError(f"Invalid {k} type")
+    return GraphRequest(self._range_url(file_id, sheetname, range), "get", None)
 
   def insert_empty_cells(self, file_id, sheetname, range, shift="Down"):
     '''
@@ -148,17 +231,16 @@ class ExcelClient(object):
                       The possible values are: "Down", "Right"
                       Default value is "Down"
     :type:            str
-    :return:          The list with the endpoint of the query, the type of the query and the body of the query
-    :type:            list
+    :return:          The endpoint of the query, the type of the query and the body of the query
+    :type:            GraphRequest
     '''
-    for [k, v] in {'file_id': file_id, 'sheetname': sheetname, 'range': range, 'shift': shift}.items():
-      if type(v) is not str:
-        raise TypeError("Invalid {0} type".format(k))
+    for k, v in (('file_id', file_id), ('sheetname', sheetname), ('range', range), ('shift', shift)):
+      if not isinstance(v, str):
+        raise TypeError(f"Invalid {k} type")
     request_body = {
       "shift": shift
     }
-    return ["/me/drive/items/{0}/workbook/worksheets/{1}/range(address=\'{2}\')/insert".format(file_id, sheetname, range),
-      "post", request_body]
+    return GraphRequest(self._range_url(file_id, sheetname, range, "/insert"), "post", request_body)
 
   def clear_range(self, file_id, sheetname, range, applyTo="All"):
     '''
@@ -174,20 +256,19 @@ class ExcelClient(object):
                         The possible values are: "All", "Formats", "Contents"
                         Default value is "All"
       :type:            str
-      :return:          The list with the endpoint of the query, the type of the query and the body of the query
-      :type:            list
+      :return:          The endpoint of the query, the type of the query and the body of the query
+      :type:            GraphRequest
 
       !!!If successful, this method returns 200 OK response code. It does not return anything in the response body.
       Therefore, you will see a ValueError in the response body.
       '''
-    for [k, v] in {'file_id': file_id, 'sheetname': sheetname, 'range': range, 'applyTo': applyTo}.items():
-      if type(v) is not str:
-        raise TypeError("Invalid {0} type".format(k))
+    for k, v in (('file_id', file_id), ('sheetname', sheetname), ('range', range), ('applyTo', applyTo)):
+      if not isinstance(v, str):
+        raise TypeError(f"Invalid {k} type")
     request_body = {
       "applyTo": applyTo
     }
-    return ["/me/drive/items/{0}/workbook/worksheets/{1}/range(address=\'{2}\')/clear".format(file_id, sheetname, range),
-      "post", request_body]
+    return GraphRequest(self._range_url(file_id, sheetname, range, "/clear"), "post", request_body)
 
   def delete_range(self, file_id, sheetname, range, shift="Up"):
     '''
@@ -202,20 +283,19 @@ class ExcelClient(object):
       :param shift:     Specifies which way to shift the cells. The possible values are: "Up", "Left"
                         Default value is "Up"
       :type:            str
-      :return:          The list with the endpoint of the query, the type of the query and the body of the query
-      :type:            list
+      :return:          The endpoint of the query, the type of the query and the body of the query
+      :type:            GraphRequest
 
       !!!If successful, this method returns 200 OK response code. It does not return anything in the response body.
       Therefore, you will see a ValueError in the response body.
       '''
-    for [k, v] in {'file_id': file_id, 'sheetname': sheetname, 'range': range, 'shift': shift}.items():
-      if type(v) is not str:
-        raise TypeError("Invalid {0} type".format(k))
+    for k, v in (('file_id', file_id), ('sheetname', sheetname), ('range', range), ('shift', shift)):
+      if not isinstance(v, str):
+        raise TypeError(f"Invalid {k} type")
     request_body = {
       "shift": shift
     }
-    return ["/me/drive/items/{0}/workbook/worksheets/{1}/range(address=\'{2}\')/delete".format(file_id, sheetname, range),
-      "post", request_body]
+    return GraphRequest(self._range_url(file_id, sheetname, range, "/delete"), "post", request_body)
 
   def get_rangeFormat(self, file_id, sheetname, range):
     '''
@@ -227,14 +307,13 @@ class ExcelClient(object):
       :type:            str
       :param range:     The range of cells for writing data
       :type:            str
-      :return:          The list with the endpoint of the query, the type of the query and the body of the query
-      :type:            list
+      :return:          The endpoint of the query, the type of the query and the body of the query
+      :type:            GraphRequest
     '''
-    for [k, v] in {'file_id': file_id, 'sheetname': sheetname, 'range': range}.items():
-      if type(v) is not str:
-        raise TypeError("Invalid {0} type".format(k))
-    return ["/me/drive/items/{0}/workbook/worksheets/{1}/range(address=\'{2}\')/format".format(file_id, sheetname, range),
-      "get", None]
+    for k, v in (('file_id', file_id), ('sheetname', sheetname), ('range', range)):
+      if not isinstance(v, str):
+        raise TypeError(f"Invalid {k} type")
+    return GraphRequest(self._range_url(file_id, sheetname, range, "/format"), "get", None)
 
   def get_data(self, path):
     '''
@@ -245,11 +324,27 @@ class ExcelClient(object):
       :type:        str
       :return:      Data in list format
     '''
-    with open(path, 'rb') as f:
+    with open(path, 'r', newline='', encoding='utf-8') as f:
       reader = csv.reader(f)
       data = list(reader)
     return data
 
+  def get_data_shape(self, path):
+    '''
+      Counts the rows and columns of a file in csv format without keeping its rows in memory.
+
+      :param path:  The path to the file in csv format
+      :type:        str
+      :return:      The number of rows and the number of columns of the first row
+      :type:        tuple
+    '''
+    with open(path, 'r', newline='', encoding='utf-8') as f:
+      reader = csv.reader(f)
+      first = next(reader, None)
+      if first is None:
+        return (0, 0)
+      return (1 + sum(1 for _ in reader), len(first))
+
   def get_range_of_data(self, data):
     '''
     Forms the occupied range of cells in the excel file, starting with A1.
@@ -259,114 +354,103 @@ class ExcelClient(object):
     :return:      The range of cells that table will occupy, starting with A1
     :type:        str
     '''
-    if data is None:
+    if not data or not isinstance(data, list):
       raise ValueError("Invalid input data")
-    row = np.shape(data)[0]
-    try:
-      col = np.shape(data)[1]
-    except IndexError:
+    size = _shape(data)
+    if size is None:
       raise ValueError("Invalid format of data. Number of columns in lines differ")
+    return self.get_range_of_shape(*size)
 
-    degree = 26
-    digits_num = 1
-    while col >= degree:
-      degree *= 26
-      digits_num += 1
-    xl_col = ''
-    for i in range(digits_num, 0, -1):
-      n = col // (26 ** (i - 1))
-      xl_col += chr(64 + n)
-      col -= n * (26 ** (i - 1))
+  def get_range_of_shape(self, rows, cols):
+    '''
+    Forms the range of cells occupied by a table of the given size, starting with A1.
 
-    return "A1:{0}{1}".format(xl_col, row)
+    :param rows:  The number of rows of the table
+    :type:        int
+    :param cols:  The number of columns of the table
+    :type:        int
+    :return:      The range of cells that table will occupy, starting with A1
+    :type:        str
+    '''
+    if rows < 1 or cols < 1:
+      raise ValueError("Invalid input data")
+    return f"A1:{_encode_col(cols)}{rows}"
 
 def get_port(HOST):
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    while True:
-        PORT = randint(5000, 6000)
-        try:
-            s.bind((HOST, PORT))
-        except:
-            pass
-        else:
-            s.close()
-            break
-    return PORT
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+HOST = os.environ.get("HOST", "localhost")
+PORT = int(os.environ["PORT"]) if "PORT" in os.environ else get_port(HOST)
+excelclient = ExcelClient(RESOURCE="https://graph.microsoft.com",
+                          TENANT=os.environ.get("TENANT", "your tenant"),
+                          AUTHORITY_HOST_URL="https://login.microsoftonline.com",
+                          CLIENT_ID=os.environ.get("CLIENT_ID", "your client id"),
+                          CLIENT_SECRET=os.environ.get("CLIENT_SECRET", "your client secret"),
+                          API_VERSION="v1.0", HOST=HOST, PORT=PORT)
+
+data_shape = excelclient.get_data_shape(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'out.csv'))
+data_range = excelclient.get_range_of_shape(*data_shape)
+req = excelclient.delete_range(file_id="01BEQXWXBQ2QNOPSCY4NB2EEE3V2K53RA5", sheetname="Sheet1",
+                               range=data_range)
+ENDPOINT = req.endpoint
+TYPE_OF_REQUEST = req.method
+REQUEST_BODY = req.body
+_FULL_ENDPOINT = f"{excelclient.RESOURCE}/{excelclient.API_VERSION}{ENDPOINT}"
+_SEND = _METHOD_TABLE[TYPE_OF_REQUEST]
+
+
+@app.route("/")
+def main():
+    login_url = f'http://localhost:{excelclient.PORT}/login'
+    resp = flask.Response(status=307)
+    resp.headers['location'] = login_url
+    return resp
+
+
+@app.route("/login")
+def login():
+    auth_state = secrets.token_hex(16)
+    flask.session['state'] = auth_state
+    authorization_url = excelclient.TEMPLATE_AUTHZ_URL.format(
+        excelclient.TENANT,
+        excelclient.CLIENT_ID,
+        excelclient.REDIRECT_URI,
+        auth_state,
+        excelclient.RESOURCE)
+    resp = flask.Response(status=307)
+    resp.headers['location'] = authorization_url
+    return resp
+
+
+@app.route("/getAToken")
+def main_logic():
+    code = flask.request.args['code']
+    state = flask.request.args['state']
+    if state != flask.session['state']:
+        raise ValueError("State does not match")
+    auth_context = adal.AuthenticationContext(excelclient.AUTHORITY_URL)
+    token_response = auth_context.acquire_token_with_authorization_code(code, excelclient.REDIRECT_URI, excelclient.RESOURCE,
+                                                                        excelclient.CLIENT_ID, excelclient.CLIENT_SECRET)
+    # It is recommended to save this to a database when using a production app.
+    flask.session['access_token'] = token_response['accessToken']
+    return flask.redirect('/graphcall')
+
+
+@app.route('/graphcall')
+def graphcall():
+    if 'access_token' not in flask.session:
+        return flask.redirect(flask.url_for('login'))
+    # _BASE_HEADERS are merged in by the session
+    http_headers = {'Authorization': f"Bearer {flask.session['access_token']}",
+                    'client-request-id': uuid.uuid4().hex}
+    with _SEND(_FULL_ENDPOINT, headers=http_headers, json=REQUEST_BODY, stream=True, timeout=30) as resp:
+        # Parse the raw body bytes directly, without requests buffering a second copy
+        graph_data = _json.loads(resp.raw.read(decode_content=True))
+    return flask.render_template('display_graph_info.html', graph_data=graph_data)
 
-if __name__ == "__main__":
-    HOST = "localhost"
-    PORT = get_port(HOST)
-    excelclient = ExcelClient(RESOURCE="https://graph.microsoft.com", TENANT="your tenant",
-                              AUTHORITY_HOST_URL="https://login.microsoftonline.com",
-                              CLIENT_ID="your client id",
-                              CLIENT_SECRET="your client secret",
-                              API_VERSION="v1.0", HOST=HOST, PORT=PORT)
-
-    data = excelclient.get_data('out.csv')
-    range = excelclient.get_range_of_data(data)
-    configs = excelclient.delete_range(file_id="01BEQXWXBQ2QNOPSCY4NB2EEE3V2K53RA5", sheetname="Sheet1",
-                                       range=range)
-    ENDPOINT = configs[0]         # The end point of the query
-    TYPE_OF_REQUEST = configs[1]  # The type of the query
-    REQUEST_BODY = configs[2]     # The body of the query
-
-    @app.route("/")
-    def main():
-        login_url = 'http://localhost:{}/login'.format(excelclient.PORT)
-        resp = flask.Response(status=307)
-        resp.headers['location'] = login_url
-        return resp
-
-
-    @app.route("/login")
-    def login():
-        auth_state = str(uuid.uuid4())
-        flask.session['state'] = auth_state
-        authorization_url = excelclient.TEMPLATE_AUTHZ_URL.format(
-            excelclient.TENANT,
-            excelclient.CLIENT_ID,
-            excelclient.REDIRECT_URI,
-            auth_state,
-            excelclient.RESOURCE)
-        resp = flask.Response(status=307)
-        resp.headers['location'] = authorization_url
-        return resp
-
-
-    @app.route("/getAToken")
-    def main_logic():
-        code = flask.request.args['code']
-        state = flask.request.args['state']
-        if state != flask.session['state']:
-            raise ValueError("State does not match")
-        auth_context = adal.AuthenticationContext(excelclient.AUTHORITY_URL)
-        token_response = auth_context.acquire_token_with_authorization_code(code, excelclient.REDIRECT_URI, excelclient.RESOURCE,
-                                                                            excelclient.CLIENT_ID, excelclient.CLIENT_SECRET)
-        # It is recommended to save this to a database when using a production app.
-        flask.session['access_token'] = token_response['accessToken']
-        return flask.redirect('/graphcall')
-
-
-    @app.route('/graphcall')
-    def graphcall():
-        if 'access_token' not in flask.session:
-            return flask.redirect(flask.url_for('login'))
-        endpoint = excelclient.RESOURCE + '/' + excelclient.API_VERSION + ENDPOINT
-        http_headers = {'Authorization': 'Bearer ' + flask.session.get('access_token'),
-                        'User-Agent': 'adal-python-sample',
-                        'Accept': 'application/json',
-                        'Content-Type': 'application/json',
-                        'client-request-id': str(uuid.uuid4())}
-        if TYPE_OF_REQUEST == 'get':
-            graph_data = requests.get(endpoint, headers=http_headers, stream=False).json()
-        elif TYPE_OF_REQUEST == 'put':
-            graph_data = requests.put(endpoint, headers=http_headers, json=REQUEST_BODY, stream=False).json()
-        elif TYPE_OF_REQUEST == 'patch':
-            graph_data = requests.patch(endpoint, headers=http_headers, json=REQUEST_BODY, stream=False).json()
-        elif TYPE_OF_REQUEST == 'post':
-            graph_data = requests.post(endpoint, headers=http_headers, json=REQUEST_BODY, stream=False).json()
-        elif TYPE_OF_REQUEST == 'delete':
-            graph_data = requests.delete(endpoint, headers=http_headers, json=REQUEST_BODY, stream=False).json()
-        return flask.render_template('display_graph_info.html', graph_data=graph_data)
 
+if __name__ == "__main__":
     app.run(HOST, PORT)